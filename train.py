@@ -1,17 +1,22 @@
 import argparse
+import concurrent.futures
+import contextlib
+import copy
+import math
 import os
 import random
 import time
 import torch
 import torch.nn as nn
+import torch.nn.functional as F
 import torch.nn.parallel
 import torch.backends.cudnn as cudnn
 import torch.optim as optim
 import torch.utils.data
+from torch.nn.utils.fusion import fuse_conv_bn_eval
 import torchvision.datasets as dset
 import torchvision.transforms as transforms
 import torchvision.utils as vutils
-import einops as ein
 
 from FID.InceptionNet import model as inception_model
 from FID.FID import calculate_fretchet
@@ -24,7 +29,8 @@ if __name__ == "__main__":
     parser = argparse.ArgumentParser()
     parser.add_argument('--dataset', required=True, help='cifar10 | lsun | mnist |imagenet | folder | lfw | fake')
     parser.add_argument('--dataroot', required=False, help='path to dataset')
-    parser.add_argument('--workers', type=int, help='number of data loading workers', default=2)
+    parser.add_argument('--workers', type=int, help='number of data loading workers', default=min(8, os.cpu_count() or 1))
+    parser.add_argument('--prefetchFactor', type=int, default=4, help='batches loaded in advance by each worker')
     parser.add_argument('--batchSize', type=int, default=64, help='input batch size')
     parser.add_argument('--imageSize', type=int, default=64, help='the height / width of the input image to network')
     parser.add_argument('--ngf', type=int, default=64)
@@ -32,6 +38,7 @@ if __name__ == "__main__":
     parser.add_argument('--lr', type=float, default=0.0002, help='learning rate, default=0.0002')
     parser.add_argument('--beta1', type=float, default=0.5, help='beta1 for adam. default=0.5')
     parser.add_argument('--cuda', action='store_true', help='enables cuda')
+    parser.add_argument('--cudaGraph', action='store_true', help='capture the whole training step as a CUDA graph (requires --cuda)')
     parser.add_argument('--dry-run', action='store_true', help='check a single training cycle works')
     parser.add_argument('--ngpu', type=int, default=1, help='number of GPUs to use')
     parser.add_argument('--netG', default='', help="path to netG (to continue training)")
@@ -40,6 +47,8 @@ if __name__ == "__main__":
     parser.add_argument('--classes', default='bedroom', help='comma separated list of classes for the lsun data set')
 
     opt = parser.parse_args()
+    if opt.cudaGraph and not opt.cuda:
+        parser.error('--cudaGraph requires --cuda')
     print(opt)
 
     try:
@@ -63,12 +72,14 @@ if __name__ == "__main__":
 
     if opt.dataset in ['imagenet', 'folder', 'lfw']:
         # folder dataset
+        # JPEG decoding in the workers dominates the loader cost here; installing Pillow-SIMD
+        # built against libjpeg-turbo (pip uninstall pillow && pip install pillow-simd) speeds it
+        # up without code changes and lets fewer --workers keep up
         dataset = dset.ImageFolder(root=opt.dataroot,
                                 transform=transforms.Compose([
                                     transforms.Resize(opt.imageSize),
                                     transforms.CenterCrop(opt.imageSize),
                                     transforms.ToTensor(),
-                                    transforms.Normalize((0.5, 0.5, 0.5), (0.5, 0.5, 0.5)),
                                 ]))
         nc=3
     elif opt.dataset == 'lsun':
@@ -78,7 +89,6 @@ if __name__ == "__main__":
                                 transforms.Resize(opt.imageSize),
                                 transforms.CenterCrop(opt.imageSize),
                                 transforms.ToTensor(),
-                                transforms.Normalize((0.5, 0.5, 0.5), (0.5, 0.5, 0.5)),
                             ]))
         nc=3
     elif opt.dataset == 'cifar10':
@@ -86,7 +96,6 @@ if __name__ == "__main__":
                             transform=transforms.Compose([
                                 transforms.Resize(opt.imageSize),
                                 transforms.ToTensor(),
-                                transforms.Normalize((0.5, 0.5, 0.5), (0.5, 0.5, 0.5)),
                             ]))
         nc=3
 
@@ -95,9 +104,7 @@ if __name__ == "__main__":
                             transform=transforms.Compose([
                                 transforms.Resize(opt.imageSize),
                                 transforms.RandomHorizontalFlip(),
-                                transforms.RandomRotation(30, interpolation=transforms.InterpolationMode.BILINEAR),
                                 transforms.ToTensor(),
-                                transforms.Normalize((0.5,), (0.5,)),
                             ]))
             nc=1
 
@@ -108,26 +115,31 @@ if __name__ == "__main__":
 
     assert dataset
     dataloader = torch.utils.data.DataLoader(dataset, batch_size=opt.batchSize,
-                                            shuffle=True, num_workers=int(opt.workers))
+                                            shuffle=True, num_workers=int(opt.workers), drop_last=True,
+                                            pin_memory=opt.cuda, persistent_workers=(opt.workers > 0),
+                                            prefetch_factor=(opt.prefetchFactor if opt.workers > 0 else None))
 
     device = torch.device("cuda:0" if opt.cuda else "cpu")
     ngpu = int(opt.ngpu)
     ngf = int(opt.ngf)
     z_res = 4
 
-    # custom weights initialization called on netG and netD
+    # custom weights initialization called on netG and netD, applied before moving to device
+    init_generator = torch.Generator().manual_seed(opt.manualSeed)
     def weights_init(m):
-        classname = m.__class__.__name__
-        if classname.find('Conv') != -1:
-            torch.nn.init.normal_(m.weight, 0.0, 0.02)
-        elif classname.find('BatchNorm') != -1:
-            torch.nn.init.normal_(m.weight, 1.0, 0.02)
+        if isinstance(m, (nn.ConvTranspose2d, nn.Conv2d)):
+            torch.nn.init.normal_(m.weight, 0.0, 0.02, generator=init_generator)
+        elif isinstance(m, (nn.BatchNorm1d, nn.BatchNorm2d)):
+            torch.nn.init.normal_(m.weight, 1.0, 0.02, generator=init_generator)
             torch.nn.init.zeros_(m.bias)
 
 
     class Generator(nn.Module):
         def __init__(self):
             super(Generator, self).__init__()
+            # image -> latent mapping, kept as buffers so it travels with the checkpoints
+            self.register_buffer('r2', torch.randperm((z_res**2)**2))
+            self.register_buffer('rand', torch.rand([z_res**2]).sort().values)
             self.main = nn.Sequential(
                 # nn.Linear(z_res**2, z_res**2),
                 # nn.Linear(z_res**2, z_res**2),
@@ -160,67 +172,212 @@ if __name__ == "__main__":
             return self.main(input)
 
 
-    netG = Generator().to(device)
+    # eval-mode copy of the generator with each BatchNorm2d folded into the preceding ConvTranspose2d
+    def fuse_generator(netG):
+        fused = []
+        for m in copy.deepcopy(netG.main).eval():
+            if isinstance(m, nn.BatchNorm2d) and isinstance(fused[-1], nn.ConvTranspose2d):
+                fused[-1] = fuse_conv_bn_eval(fused[-1], m, transpose=True)
+            else:
+                fused.append(m)
+        return nn.Sequential(*fused)
+
+
+    # random rotation in [-degrees, degrees] for each image of a batch, done with a single grid_sample
+    def random_rotate(x, degrees):
+        angle = (torch.rand(x.size(0), device=x.device) * 2 - 1) * math.radians(degrees)
+        cos, sin, zeros = angle.cos(), angle.sin(), torch.zeros_like(angle)
+        theta = torch.stack([torch.stack([cos, -sin, zeros], 1),
+                             torch.stack([sin, cos, zeros], 1)], 1)
+        grid = F.affine_grid(theta, list(x.shape), align_corners=False)
+        return F.grid_sample(x, grid, mode='bilinear', align_corners=False)
+
+
+    netG = Generator()
     netG.apply(weights_init)
+    netG = netG.to(device)
     if opt.netG != '':
-        netG.load_state_dict(torch.load(opt.netG))
+        state_dict = torch.load(opt.netG)
+        if not {'r2', 'rand'} <= state_dict.keys():
+            raise ValueError("checkpoint \"%s\" predates the stored latent mapping (r2, rand) and the rank "
+                             "encoding of the latent, so it cannot be resumed" % opt.netG)
+        netG.load_state_dict(state_dict)
+    # NHWC layout lets cuDNN pick the tensor-core ConvTranspose2d kernels
+    netG = netG.to(memory_format=torch.channels_last)
     # print(netG)
     print("# of parameters in G:", sum(p.numel() for p in netG.parameters() if p.requires_grad))
 
+    # Compiled wrapper used for the training step; netG itself stays eager for sampling and checkpoints.
+    # With --cudaGraph the whole step is captured manually below, so netG is left uncompiled.
+    use_graph = opt.cuda and opt.cudaGraph
+    netG_train = netG
+    if opt.cuda and not use_graph:
+        netG_train = torch.compile(netG, mode='reduce-overhead', dynamic=False)
+
     inception_model = inception_model.to(device)
 
     criterion = nn.L1Loss()
 
+    # bf16 autocast for the generator step; bf16 keeps the fp32 exponent range so no GradScaler is needed.
+    # Only on Ampere and newer: older GPUs emulate bf16, which is slower than the fp32 step.
+    use_amp = opt.cuda and torch.cuda.get_device_capability(device)[0] >= 8
+
     fixed_noise = torch.randn(opt.batchSize, z_res**2, device=device)
     real_label = 1
     fake_label = 0
 
     # setup optimizer
-    optimizerG = optim.Adam(netG.parameters(), lr=opt.lr, betas=(opt.beta1, 0.999))
+    optimizerG = optim.Adam(netG.parameters(), lr=opt.lr, betas=(opt.beta1, 0.999),
+                            fused=opt.cuda, capturable=use_graph)
 
     if opt.dry_run:
         opt.niter = 1
 
-    r = torch.randperm(z_res**2)
-    r2 = torch.randperm((z_res**2)**2)
-    rand = torch.rand([z_res**2])
+    r = torch.randperm(z_res**2, device=device)
+    r2, rand = netG.r2, netG.rand
+    # (c, h, w) coordinates of the NCHW flat offsets in r2, so the channels_last input is gathered
+    # directly instead of through a contiguous flatten copy
+    r2_c = r2 // (opt.imageSize * opt.imageSize)
+    r2_h = r2 // opt.imageSize % opt.imageSize
+    r2_w = r2 % opt.imageSize
+    # Latent buffer filled in place under inference_mode; it is a normal tensor, so netG can
+    # still save it for backward
+    latent = torch.empty(opt.batchSize, z_res**2, device=device)
+
+    # CUDA graph state: a few eager warmup steps run on a side stream, then the step is captured
+    # once and replayed on the static buffers for every following batch
+    graph_warmup = 3
+    step_graph = None
+    if use_graph:
+        static_input = torch.empty(opt.batchSize, nc, opt.imageSize, opt.imageSize, device=device,
+                                   memory_format=torch.channels_last)
+        side_stream = torch.cuda.Stream()
+    step = 0
+
+    # Running loss kept on device; only read back to the host when it is logged
+    loss_accum = torch.zeros((), device=device)
+
+    # Previews are generated on a side stream and PNG-encoded on a background thread
+    preview_stream = torch.cuda.Stream() if opt.cuda else None
+    preview_executor = concurrent.futures.ThreadPoolExecutor(max_workers=1)
+    # Futures are kept so a failed PNG write is raised in the training loop
+    real_future = None
+
+    def save_preview(images, path, ready=None):
+        if ready is not None:
+            ready.synchronize()
+        vutils.save_image(images, path, normalize=True)
+
+    # Pinned host buffers reused by the device-to-host preview copies; the step snapshots and the
+    # fixed_noise samples each get their own so they never wait on each other
+    stage = torch.empty(opt.batchSize, nc, opt.imageSize, opt.imageSize, pin_memory=True) if opt.cuda else None
+    fixed_stage = torch.empty_like(stage, pin_memory=True) if opt.cuda else None
+    stage_future = None
+    fixed_future = None
+
+    def save_preview_async(images, path, stage, stage_future=None):
+        # the previous preview may still be encoding from the staging buffer; waiting on it
+        # also raises any error from that write
+        if stage_future is not None:
+            stage_future.result()
+        if not opt.cuda:
+            return preview_executor.submit(save_preview, images, path)
+        stage.copy_(images, non_blocking=True)
+        ready = torch.cuda.current_stream().record_event()
+        return preview_executor.submit(save_preview, stage, path, ready)
 
     for epoch in range(opt.niter):
+        loss_accum.zero_()
+        loss_count = 0
         for i, data in enumerate(dataloader, 0):
-            input = data[0].to(device)
+            input = data[0].to(device, non_blocking=True, memory_format=torch.channels_last)
+            if opt.dataset == 'mnist':
+                # Rotated before normalizing so the padding stays black, like RandomRotation's fill
+                input = random_rotate(input, 30)
+            # Normalize to [-1, 1] on the whole batch instead of per sample in the workers
+            input = input.mul_(2.0).sub_(1.0)
             # input = ein.reduce(input, "b c (h i) (w j) -> b (h w)", "mean", i=opt.imageSize//z_res, j=opt.imageSize//z_res) # Avg pool to 8x8 then to z
             
             # # NOTE: Maybe shuffle here?
             # input = input[:,r]
 
-            netG.zero_grad()
             # output = netG(input)
 
-            with torch.no_grad():
-                t = input.flatten(1)[:, r2]
-                t = ein.reduce(t, "b (n i) -> b n", "mean", i=z_res**2)
-                t = t.argsort(1)
-                t = rand[t]
-
-            output = netG(t)
-            errG = criterion(output, input)
-            errG.backward()
-            optimizerG.step()
+            with torch.inference_mode():
+                t = input[:, r2_c, r2_h, r2_w]
+                t = t.view(t.size(0), z_res**2, z_res**2).mean(dim=2)
+                # Each region gets the sorted random value matching its rank
+                idx = t.argsort(dim=1)
+                t = latent.scatter_(1, idx, rand.expand_as(idx))
+
+            if use_graph and step_graph is None and step >= graph_warmup:
+                optimizerG.zero_grad(set_to_none=True)
+                step_graph = torch.cuda.CUDAGraph()
+                # thread_local: the pin_memory and preview writer threads keep making CUDA calls
+                # (cudaHostAlloc, event queries) during capture, which global mode would reject
+                with torch.cuda.graph(step_graph, capture_error_mode="thread_local"):
+                    with torch.autocast(device_type=device.type, dtype=torch.bfloat16, enabled=use_amp, cache_enabled=False):
+                        static_output = netG(latent)
+                        static_err = criterion(static_output, static_input)
+                    static_err.backward()
+                    optimizerG.step()
+
+            if step_graph is not None:
+                static_input.copy_(input)
+                step_graph.replay()
+                output, errG = static_output, static_err
+            else:
+                if use_graph:
+                    side_stream.wait_stream(torch.cuda.current_stream())
+                with torch.cuda.stream(side_stream) if use_graph else contextlib.nullcontext():
+                    optimizerG.zero_grad(set_to_none=True)
+                    with torch.autocast(device_type=device.type, dtype=torch.bfloat16, enabled=use_amp):
+                        output = netG_train(t)
+                        errG = criterion(output, input)
+                    errG.backward()
+                    optimizerG.step()
+                if use_graph:
+                    torch.cuda.current_stream().wait_stream(side_stream)
+            step += 1
+            loss_accum += errG.detach()
+            loss_count += 1
 
             if i % 100 == 0:
                 print('[%d/%d][%d/%d] Loss_G: %.4f '
-                    % (epoch, opt.niter, i, len(dataloader), errG.item()))
-                vutils.save_image(data[0],
-                        '%s/real_samples.png' % opt.outf,
-                        normalize=True)
-                with torch.no_grad():
-                    fake = netG(fixed_noise)
-                vutils.save_image(fake.detach(),
+                    % (epoch, opt.niter, i, len(dataloader), (loss_accum / loss_count).item()))
+                loss_accum.zero_()
+                loss_count = 0
+                if real_future is not None:
+                    real_future.result()
+                real_future = preview_executor.submit(save_preview, data[0],
+                        '%s/real_samples.png' % opt.outf)
+                # Reuse this step's output rather than running an extra forward pass
+                stage_future = save_preview_async(output.detach(),
                         '%s/fake_samples_epoch_%03d_%03d.png' % (opt.outf, epoch, i),
-                        normalize=True)
+                        stage, stage_future)
 
             if opt.dry_run:
                 break
+
+        # Log the steps since the last line so every step of the epoch is reported
+        if loss_count > 0:
+            print('[%d/%d][%d/%d] Loss_G: %.4f '
+                % (epoch, opt.niter, len(dataloader), len(dataloader), (loss_accum / loss_count).item()))
+
+        # Sample fixed_noise once per epoch. The folded copy is built on the default stream so it
+        # reads the weights before the next optimizer step.
+        netG_eval = fuse_generator(netG)
+        if opt.cuda:
+            preview_stream.wait_stream(torch.cuda.current_stream())
+            for p in netG_eval.parameters():
+                p.record_stream(preview_stream)
+        with torch.cuda.stream(preview_stream) if opt.cuda else contextlib.nullcontext():
+            with torch.no_grad():
+                fake = netG_eval(fixed_noise)
+            fixed_future = save_preview_async(fake,
+                    '%s/fixed_samples_epoch_%03d.png' % (opt.outf, epoch),
+                    fixed_stage, fixed_future)
+
         # # Save FID
         # with torch.no_grad():
         #     if real_cpu.shape[1] == 1:
@@ -232,3 +389,8 @@ if __name__ == "__main__":
 
         # do checkpointing
         torch.save(netG.state_dict(), '%s/netG_epoch_%d.pth' % (opt.outf, epoch))
+
+    preview_executor.shutdown()
+    for future in (real_future, stage_future, fixed_future):
+        if future is not None:
+            future.result()